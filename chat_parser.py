@@ -0,0 +1,57 @@
+### This file contains the streaming parser for chat JSON exports
+
+import ijson
+
+def iter_chats(stream):
+    # Yields chats from a streamed JSON body. A bare list of chats is yielded one chat at a time
+    # as it is parsed. For an object root, a top-level "messages" key marks a single chat and takes
+    # precedence over "data"; since that key may come after "data", the chats of a {"data": [...]}
+    # wrapper are only yielded once the root object is complete.
+    root = ijson.ObjectBuilder()
+    item_prefix = None
+    saw_messages = False
+    pending = []
+    chat = None
+    depth = 0
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if chat is None and prefix == "":
+            if event == "start_array":
+                print("Detected list of chats.")
+                item_prefix = "item"
+            elif event == "map_key" and value == "messages":
+                saw_messages = True
+            elif event == "map_key" and value == "data" and not saw_messages:
+                item_prefix = "data.item"
+
+        # Route each list element to its own builder so only one is being built at a time
+        if chat is None and prefix == item_prefix and event == "start_map":
+            chat = ijson.ObjectBuilder()
+        if chat is not None:
+            chat.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                if item_prefix == "item":
+                    yield chat.value
+                else:
+                    pending.append(chat.value)
+                chat = None
+            continue
+
+        root.event(event, value)
+
+    data = getattr(root, "value", None)
+    if isinstance(data, dict) and "messages" in data:
+        print("Detected single chat file structure.")
+        # Put back any "data" entries that were routed away while the root type was unknown
+        if pending:
+            data.setdefault("data", []).extend(pending)
+        yield data
+    elif isinstance(data, dict) and item_prefix == "data.item":
+        print("Detected wrapper structure with 'data' key.")
+        yield from pending
+    elif item_prefix is None:
+        print("JSON structure not recognized. Could not find 'messages' or 'data'.")
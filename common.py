@@ -0,0 +1,69 @@
+### This file contains helpers shared by the ingestion pipeline and the search engine
+
+import os
+import json
+import threading
+from functools import lru_cache
+from urllib.request import urlopen
+from dotenv import load_dotenv
+from pinecone import Pinecone
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+# Loaded here too, since this module is imported before its callers load the .env file
+load_dotenv()
+
+GOOGLE_EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Optional self-hosted Text Embeddings Inference (TEI) server, e.g. http://localhost:8080.
+# Read only here, so the embeddings client, batch sizing and the embedding cache key always agree.
+EMBEDDINGS_ENDPOINT = os.getenv("EMBEDDINGS_ENDPOINT")
+# Name of the model served at EMBEDDINGS_ENDPOINT; read from the TEI server's /info when unset
+EMBEDDINGS_MODEL = os.getenv("EMBEDDINGS_MODEL")
+
+@lru_cache(maxsize=1)
+def get_pinecone_client():
+    # Created on first use, then shared so every call reuses the same keep-alive connection pool
+    return Pinecone(api_key=os.getenv('PINECONE_API_KEY', ''))
+
+# Index handles reused by every caller in this process (warm serverless containers included).
+# Each handle owns its own data-plane connection pool and, once async_req is used, its own
+# thread pool, so handles are created once per index instead of once per call.
+_INDEX_CACHE = {}
+_INDEX_CACHE_LOCK = threading.Lock()
+
+def get_index(index_name, pool_threads=1):
+    # pool_threads sizes the thread pool that runs async_req requests; only parallel upserts need more than one.
+    # The first call per index resolves its host and warms the connection pool in the background.
+    key = (index_name, pool_threads)
+    with _INDEX_CACHE_LOCK:
+        if key not in _INDEX_CACHE:
+            index = get_pinecone_client().Index(index_name, pool_threads=pool_threads)
+            # A cheap stats call opens the TLS connection so the first real request doesn't pay for it
+            threading.Thread(target=index.describe_index_stats, daemon=True).start()
+            _INDEX_CACHE[key] = index
+        return _INDEX_CACHE[key]
+
+def get_embeddings():
+    # The index must be built and queried with the same model, so ingestion and search both use this
+    if EMBEDDINGS_ENDPOINT:
+        # Only needed when a TEI server is configured
+        from langchain_huggingface import HuggingFaceEndpointEmbeddings
+        return HuggingFaceEndpointEmbeddings(model=EMBEDDINGS_ENDPOINT)
+    return GoogleGenerativeAIEmbeddings(model=GOOGLE_EMBEDDING_MODEL)
+
+@lru_cache(maxsize=1)
+def get_embedding_model_id():
+    # The model behind get_embeddings() - an endpoint URL says nothing about which model it serves
+    if not EMBEDDINGS_ENDPOINT:
+        return GOOGLE_EMBEDDING_MODEL
+    if EMBEDDINGS_MODEL:
+        return EMBEDDINGS_MODEL
+    with urlopen(f"{EMBEDDINGS_ENDPOINT.rstrip('/')}/info", timeout=10) as response:
+        return json.loads(response.read())["model_id"]
+
+def embed_query_batch(embeddings, queries):
+    # Embeds several search queries in one request. Google embeds embed_documents() input as documents
+    # by default, so it is told these are queries - the same task type embed_query() uses.
+    if isinstance(embeddings, GoogleGenerativeAIEmbeddings):
+        return embeddings.embed_documents(queries, task_type="RETRIEVAL_QUERY")
+    return embeddings.embed_documents(queries)
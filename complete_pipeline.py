@@ -1,19 +1,262 @@
 ### This file contains code that takes s3 uri of single chat json and then load and ingest data into pinecone
 
-import json
+import io
+import sys
+import multiprocessing
+import sqlite3
+import orjson
+import time
+import threading
 import boto3
-from langchain_core.documents import Document
+import xxhash
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import ChainMap
+from contextlib import closing
+from functools import lru_cache
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import os
-from pinecone import Pinecone, ServerlessSpec
-from langchain_pinecone import PineconeVectorStore
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from pinecone import PodSpec, ServerlessSpec
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from chat_parser import iter_chats
+from common import EMBEDDINGS_ENDPOINT, get_embedding_model_id, get_embeddings, get_index, get_pinecone_client
 
 load_dotenv()
 
+# AWS clients are created once per process and reused across calls
 lambda_client = boto3.client('lambda')
+s3_client = boto3.client('s3')
+
+# Embedding batching - the Google API accepts up to 100 texts per request; TEI takes larger
+# batches when started with --max-client-batch-size 128
+EMBED_BATCH_SIZE = 128 if EMBEDDINGS_ENDPOINT else 100
+EMBED_MAX_WORKERS = 8
+UPSERT_BATCH_SIZE = 100
+
+# Output size of the embedding model; also part of the embedding cache key
+EMBED_DIMENSION = int(os.getenv('Dimension', 768))
+
+# Local content-hash -> vector cache, so repeated chunks ("ok", "thanks", ...) are embedded once
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embed_cache.db")
+# Stay well below SQLite's limit on bound parameters per statement
+EMBED_CACHE_LOOKUP_BATCH = 500
+
+def embed_texts(embeddings, texts):
+    # Split texts into API-sized batches and embed them concurrently, keeping input order.
+    # Vectors are packed into one float32 matrix (Pinecone's storage precision) instead of
+    # being kept as lists of Python floats, which take ~8x the memory.
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    if not batches:
+        return np.empty((0, 0), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as executor:
+        results = executor.map(embeddings.embed_documents, batches)
+        return np.vstack([np.asarray(batch, dtype=np.float32) for batch in results])
+
+def _content_hash(model_key, text):
+    # Lowercased, whitespace-collapsed text, keyed by model and dimension so vectors from
+    # different models never mix
+    normalized = " ".join(text.lower().split())
+    return xxhash.xxh3_64_digest(f"{model_key}\0{normalized}".encode("utf-8"))
+
+def _load_cached_vectors(hashes):
+    # Maps each distinct hash to its cached vector, or None when it still has to be embedded
+    vectors_by_hash = dict.fromkeys(hashes)
+    with closing(sqlite3.connect(EMBED_CACHE_PATH)) as cache:
+        cache.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vector BLOB)")
+        unique_hashes = list(vectors_by_hash)
+        for start in range(0, len(unique_hashes), EMBED_CACHE_LOOKUP_BATCH):
+            lookup = unique_hashes[start:start + EMBED_CACHE_LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(lookup))
+            for h, vector in cache.execute(f"SELECT hash, vector FROM embeddings WHERE hash IN ({placeholders})", lookup):
+                vectors_by_hash[h] = np.frombuffer(vector, dtype=np.float32)
+    return vectors_by_hash
+
+def _store_cached_vectors(hashes, vectors):
+    with closing(sqlite3.connect(EMBED_CACHE_PATH)) as cache, cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO embeddings (hash, vector) VALUES (?, ?)",
+            [(h, vector.tobytes()) for h, vector in zip(hashes, vectors)],
+        )
+
+def embed_texts_cached(embeddings, texts):
+    # Embeds each distinct chunk once, reusing vectors from the local cache across runs,
+    # and expands the results back to one row per input text in input order
+    if not texts:
+        return embed_texts(embeddings, texts)
+
+    # The cache is best-effort: if the model can't be identified or the cache file can't be
+    # opened (e.g. a read-only filesystem on Lambda), embed everything without it
+    try:
+        model_key = f"{get_embedding_model_id()}\0{EMBED_DIMENSION}"
+        hashes = [_content_hash(model_key, text) for text in texts]
+        vectors_by_hash = _load_cached_vectors(hashes)
+    except Exception as e:
+        print(f"Embedding cache unavailable, embedding all chunks: {e}")
+        return embed_texts(embeddings, texts)
+
+    missing = [h for h, vector in vectors_by_hash.items() if vector is None]
+    print(f"Embedding {len(missing)} of {len(texts)} chunks ({len(vectors_by_hash) - len(missing)} distinct chunks cached).")
+
+    if missing:
+        # The first original text for each hash stands in for all of its duplicates
+        text_by_hash = {}
+        for h, text in zip(hashes, texts):
+            text_by_hash.setdefault(h, text)
+
+        new_vectors = embed_texts(embeddings, [text_by_hash[h] for h in missing])
+        vectors_by_hash.update(zip(missing, new_vectors))
+
+        try:
+            _store_cached_vectors(missing, new_vectors)
+        except Exception as e:
+            print(f"Could not update embedding cache: {e}")
+
+    return np.vstack([vectors_by_hash[h] for h in hashes])
+
+@lru_cache(maxsize=1)
+def get_splitter():
+    # Built once per process so pool workers do not reload the tokenizer for every message
+    # Token-aware 512-token chunks with ~10% overlap
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base",
+        chunk_size=512,
+        chunk_overlap=50,
+    )
+
+def _split_one(text):
+    # Process pool worker - only the text crosses the process boundary, metadata stays in the parent
+    return get_splitter().split_text(text or "")
+
+# Most chat messages fit in one chunk, so splitting is cheap; below this much text the process
+# pool's startup (and loading the tokenizer in every worker) costs more than it saves
+SPLIT_POOL_MIN_CHARS = 10_000_000
+
+def split_texts(texts):
+    # Returns each text's chunks in input order, using a process pool only for large inputs
+    if sum(len(text or "") for text in texts) >= SPLIT_POOL_MIN_CHARS:
+        try:
+            # Spawned rather than forked workers: the classification Lambda call runs on a background
+            # thread, and forking a multi-threaded process can deadlock on locks held by that thread
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as executor:
+                return list(executor.map(_split_one, texts, chunksize=64))
+        except OSError as e:
+            # e.g. AWS Lambda, which has no /dev/shm for multiprocessing primitives
+            print(f"Process pool unavailable ({e}); splitting in-process.")
+    return [_split_one(text) for text in texts]
+
+# Chats are chunked, embedded and written in batches of about this much message text, so memory
+# stays bounded on large exports while a full batch is still big enough to use the split pool
+INGEST_BATCH_CHARS = SPLIT_POOL_MIN_CHARS
+
+# Threads used by the ingest index handle to send async_req upsert batches in parallel
+UPSERT_POOL_THREADS = 32
+
+# Metadata fields used in query filters. Pod indexes only index these; serverless indexes
+# have no metadata_config and index every field. "chat_user" and "cached_at" are filtered on
+# by the search engine's semantic answer cache.
+INDEXED_METADATA_FIELDS = ["chat_user", "cached_at", "chat_account", "chat_id", "accessibility"]
+POD_ENVIRONMENT = os.getenv("PINECONE_POD_ENVIRONMENT")
+
+# Bulk import - set BULK=1 to stage vectors as Parquet in S3 and let Pinecone import them
+BULK_IMPORT = os.getenv("BULK") == "1"
+IMPORT_PREFIX = "pinecone_import"
+IMPORT_POLL_SECONDS = 30
+# Pinecone reports the default namespace as "" (older API versions) or "__default__"
+DEFAULT_NAMESPACES = ("", "__default__")
+
+def chunk_metadata(text, msg_meta, chunk_index):
+    # Flattens a chunk record into the plain dict Pinecone stores;
+    # "text" is the key PineconeVectorStore reads the chunk content from
+    return {
+        **msg_meta,
+        "chunk_index": chunk_index,
+        "chunk_id": f"{msg_meta.get('chat_id')}::{msg_meta.get('turn_id')}::{chunk_index}",
+        "text": text,
+    }
+
+def write_import_parquet(bucket_name, import_key, part, records, vectors):
+    # Pinecone expects id/values/metadata columns, with metadata as a JSON string,
+    # under a <prefix>/<namespace>/ folder ("__default__" is the default namespace);
+    # every batch is written as its own part file and one import picks them all up
+    ids = []
+    metadata_json = []
+    for record in records:
+        md = chunk_metadata(*record)
+        ids.append(md["chunk_id"])
+        metadata_json.append(orjson.dumps(md).decode('utf-8'))
+
+    table = pa.table({
+        "id": ids,
+        # Build the list<float32> column straight from the float32 matrix without copying it per row
+        "values": pa.ListArray.from_arrays(
+            pa.array(np.arange(0, vectors.size + 1, vectors.shape[1], dtype=np.int32)),
+            pa.array(vectors.ravel()),
+        ),
+        "metadata": metadata_json,
+    })
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+
+    import_uri = f"s3://{bucket_name}/{IMPORT_PREFIX}/{import_key}/"
+    s3_client.put_object(
+        Bucket=bucket_name,
+        Key=f"{IMPORT_PREFIX}/{import_key}/__default__/part-{part:05d}.parquet",
+        Body=buffer.getvalue(),
+    )
+    return import_uri
+
+def open_index(index_name):
+    # Returns the cached handle for the index, creating the index first if it does not exist
+    pc = get_pinecone_client()
+    if index_name not in [i["name"] for i in pc.list_indexes()]:
+        if POD_ENVIRONMENT:
+            spec = PodSpec(
+                environment=POD_ENVIRONMENT,
+                metadata_config={"indexed": INDEXED_METADATA_FIELDS},
+            )
+        else:
+            spec = ServerlessSpec(cloud="aws", region="us-east-1")
+
+        pc.create_index(
+            name=index_name,
+            dimension=EMBED_DIMENSION,
+            metric="cosine",
+            spec=spec,
+        )
+
+    # Cached per process, so warm containers reuse its connections and upsert threads
+    return get_index(index_name, pool_threads=UPSERT_POOL_THREADS)
+
+def upsert_records(index, records, vectors):
+    # Upsert precomputed vectors directly, building metadata dicts one batch at a time;
+    # batches are sent in parallel on the index's thread pool and awaited together
+    pending = []
+    for start in range(0, len(records), UPSERT_BATCH_SIZE):
+        end = start + UPSERT_BATCH_SIZE
+        batch = [chunk_metadata(*record) for record in records[start:end]]
+        pending.append(index.upsert(
+            vectors=[(md["chunk_id"], vector, md) for md, vector in zip(batch, vectors[start:end].tolist())],
+            async_req=True,
+        ))
+    for result in pending:
+        result.get()
+
+def default_namespace_exists(index):
+    # Pinecone refuses to import into a namespace that already holds records
+    namespaces = index.describe_index_stats().namespaces or {}
+    return any(name in namespaces for name in DEFAULT_NAMESPACES)
+
+def poll_import(index, import_id):
+    # Log the import progress until Pinecone reports a final state
+    while True:
+        status = index.describe_import(id=import_id).status
+        print(f"Import {import_id} status: {status}")
+        if status in ("Completed", "Failed", "Cancelled"):
+            return status
+        time.sleep(IMPORT_POLL_SECONDS)
 
 def invoke_lambda(test_event):
     try:
@@ -21,11 +264,11 @@ def invoke_lambda(test_event):
         response = lambda_client.invoke(
             FunctionName='ConversationAccess-Json-UAT',  
             InvocationType='RequestResponse',  
-            Payload=json.dumps(test_event)  
+            Payload=orjson.dumps(test_event)  
         )
         
         # Read and parse the response
-        response_payload = json.loads(response['Payload'].read().decode('utf-8'))
+        response_payload = orjson.loads(response['Payload'].read())
         
         # Return the Lambda response body
         return response_payload
@@ -34,13 +277,7 @@ def invoke_lambda(test_event):
         print(f"Error invoking Lambda: {e}")
         return None
 
-def s3_json_load_ingest(s3_uri: str, lambda_event: dict):
-    # Call Lambda function with the event and get the response
-    lambda_response = invoke_lambda(lambda_event)
-    if not lambda_response:
-        print("Error receiving response from Lambda.")
-        return []
-
+def classify_accessibility(lambda_response):
     # Extract the necessary fields from the Lambda response
     category_one = lambda_response["body"]["category_one"]
     category_two = lambda_response["body"]["category_two"]
@@ -63,130 +300,168 @@ def s3_json_load_ingest(s3_uri: str, lambda_event: dict):
     # Log the final decision for debugging
     print(f"Final Decision - Accessibility: {accessibility}, Accessibility Confidence Score: {accessibility_confidence_score}")
 
+    return {
+        "accessibility": accessibility,
+        "accessibility_confidence_score": accessibility_confidence_score
+    }
+
+def iter_doc_batches(chats, classification):
+    # Turns streamed chats into (text, metadata) pairs, yielded in lists of about INGEST_BATCH_CHARS
+    # characters so each batch is processed before the rest of the file is parsed.
+    # Metadata is a ChainMap layering per-message fields over one shared per-chat dict and the
+    # classification, which is filled in once the Lambda responds.
+    docs = []
+    batch_chars = 0
+
+    for chat in chats:
+        if "messages" not in chat:
+            print(f"No messages found for chat_id: {chat.get('chat_id')}")
+            continue
+
+        # Fields identical for every message of the chat are stored once
+        chat_meta = {
+            "chat_engine": chat.get("chat_engine", os.getenv("CHAT_ENGINE")),
+            "chat_account": chat.get("chat_user", os.getenv('CHAT_USER')),
+            "chat_id": chat.get("chat_id"),
+            "title": chat.get("title"),
+            "chat_creation_time": chat.get("chat_creation_time"),
+        }
+
+        for msg in chat["messages"]:
+            content = msg.get("message") or ""
+            author = msg.get("author")
+
+            msg_meta = ChainMap({
+                "turn_id": msg.get("turn_id"),
+                "author": sys.intern(author) if isinstance(author, str) else author,
+                "turn_timestamp": msg.get("turn_timestamp"),
+            }, chat_meta, classification)
+
+            docs.append((content, msg_meta))
+            batch_chars += len(content)
+            if batch_chars >= INGEST_BATCH_CHARS:
+                yield docs
+                docs = []
+                batch_chars = 0
+
+    if docs:
+        yield docs
+
+def s3_json_load_ingest(s3_uri: str, lambda_event: dict):
+    # Returns {"chunks": <chunks ingested>, "import_id": <bulk import id, or None for upserts>} on success,
+    # including a file with nothing to ingest, and None on any failure (the error is logged)
+    # Call the Lambda function in the background so classification overlaps with
+    # streaming and chunking the first batch; its result is only needed before embedding
+    classifier = ThreadPoolExecutor(max_workers=1)
+    lambda_future = classifier.submit(invoke_lambda, lambda_event)
+    classifier.shutdown(wait=False)
+
+    # Filled in once the Lambda responds; every chunk's metadata reads through to it
+    classification = {}
+
     # Parse the S3 URI
     parsed_uri = urlparse(s3_uri)
     bucket_name = parsed_uri.netloc
     file_key = parsed_uri.path.lstrip('/')
 
-    # Initialize S3 client
-    s3_client = boto3.client('s3')
-
     try:
-        # Download the file from S3
+        # Stream the file from S3 and parse chats as they arrive instead of loading the whole body
         response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-        data = json.loads(file_content)
-
-        print("Loaded data from S3.")
-
-        # Check for different possible JSON structures
-        chats = []
-
-        if isinstance(data, dict) and "messages" in data:
-            print("Detected single chat file structure.")
-            chats = [data]  # Wrap it in a list for further processing
-            
-        elif isinstance(data, dict) and "data" in data:
-            print("Detected wrapper structure with 'data' key.")
-            chats = data["data"]
-            
-        elif isinstance(data, list):
-            print("Detected list of chats.")
-            chats = data
-            
-        else:
-            print("JSON structure not recognized. Could not find 'messages' or 'data'.")
-            return []
+        chats = iter_chats(response['Body'])
 
-        docs = []
+        print("Streaming data from S3.")
 
-        # Iterate through the chats and create documents
-        for chat in chats:
-            if "messages" not in chat:
-                print(f"No messages found for chat_id: {chat.get('chat_id')}")
+        # Pinecone integration, set up when the first batch produces chunks
+        INDEX_NAME = os.getenv('PINECONE_INDEX', '')
+        index = None
+        embeddings = None
+        import_key = None
+        doc_count = 0
+        chunk_count = 0
+        parts = 0
+
+        for docs in iter_doc_batches(chats, classification):
+            doc_count += len(docs)
+
+            # Flat (text, message metadata, chunk index) records - one tuple per chunk;
+            # metadata dicts are only built per upsert batch in chunk_metadata()
+            records = []
+
+            # Split documents into chunks, keeping document order
+            split_results = split_texts([content for content, _ in docs])
+            for (_, msg_meta), chunks in zip(docs, split_results):
+                records.extend((chunk, msg_meta, i) for i, chunk in enumerate(chunks))
+
+            if not records:
                 continue
 
-            for msg in chat["messages"]:
-                content = msg.get("message") or ""
-
-                # Use extracted values in the metadata
-                meta = {
-                    "chat_engine": chat.get("chat_engine", os.getenv("CHAT_ENGINE")),
-                    "chat_account": chat.get("chat_user", os.getenv('CHAT_USER')),
-                    "chat_id": chat.get("chat_id"),
-                    "title": chat.get("title"),
-                    "chat_creation_time": chat.get("chat_creation_time"),
-                    "turn_id": msg.get("turn_id"),
-                    "author": msg.get("author"),
-                    "turn_timestamp": msg.get("turn_timestamp"),
-                    "accessibility": accessibility,
-                    "accessibility_confidence_score": accessibility_confidence_score
-                }
-
-                docs.append(Document(page_content=content, metadata=meta))
-
-        if docs:
-            print(f"Created {len(docs)} documents.")
-        else:
-            print("No documents were created.")
-            return []
-
-        # Initialize text splitter - Increased chunk size for better RAG context
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=150,  # Adjusted for better chunking
-            chunk_overlap=30,
-            separators=["\n\n", "\n", " ", ""],
-        )
+            if index is None:
+                # Wait for the classification before spending any embedding calls
+                lambda_response = lambda_future.result()
+                if not lambda_response:
+                    print("Error receiving response from Lambda.")
+                    return None
+                classification.update(classify_accessibility(lambda_response))
 
-        chunked_docs = []
+                index = open_index(INDEX_NAME)
 
-        # Split documents into chunks
-        for d in docs:
-            chunks = splitter.split_text(d.page_content or "")
-            for i, chunk in enumerate(chunks):
-                md = dict(d.metadata)
-                md["chunk_index"] = i
-                md["chunk_id"] = f"{md.get('chat_id')}::{md.get('turn_id')}::{i}"
-                chunked_docs.append(Document(page_content=chunk, metadata=md))
+                # Fail before spending embedding calls or staging a file for an import that cannot succeed
+                if BULK_IMPORT and default_namespace_exists(index):
+                    print(f"Bulk import unavailable: index '{INDEX_NAME}' already has records in the default namespace. "
+                          "Pinecone only imports into new namespaces; unset BULK to upsert instead.")
+                    return None
 
-        # Pinecone integration
-        INDEX_NAME = os.getenv('PINECONE_INDEX', '')
-        DIMENSION = 768
+                embeddings = get_embeddings()
+                import_key = records[0][1].get("chat_id") or os.path.splitext(os.path.basename(file_key))[0]
 
-        pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY', ''))
+            # Embed all distinct, uncached chunks in batches instead of letting the vector store embed them serially
+            vectors = embed_texts_cached(embeddings, [text for text, _, _ in records])
 
-        # Check if the index exists or create it
-        if INDEX_NAME not in [i["name"] for i in pc.list_indexes()]:
-            pc.create_index(
-                name=INDEX_NAME,
-                dimension=DIMENSION,
-                metric="cosine",
-                spec=ServerlessSpec(cloud="aws", region="us-east-1"),
-            )
+            if BULK_IMPORT:
+                # Pinecone only imports into namespaces that do not exist yet, so this path is meant for backfills
+                import_uri = write_import_parquet(bucket_name, import_key, parts, records, vectors)
+                parts += 1
+            else:
+                upsert_records(index, records, vectors)
 
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+            chunk_count += len(records)
+            print(f"Processed {doc_count} documents ({chunk_count} chunks) so far.")
 
-        # Create a PineconeVectorStore from the chunked documents
-        vectorstore = PineconeVectorStore.from_documents(
-            documents=chunked_docs,
-            embedding=embeddings,
-            index_name=INDEX_NAME,
-        )
+        if not doc_count:
+            print("No documents were created.")
+        elif not chunk_count:
+            print("No chunks were created.")
+        if not chunk_count:
+            return {"chunks": 0, "import_id": None}
+
+        if BULK_IMPORT:
+            import_id = index.start_import(
+                uri=import_uri,
+                integration_id=os.getenv("PINECONE_INTEGRATION_ID"),
+            ).id
+            print(f"Started Pinecone import {import_id} from {import_uri}")
+
+            # Report progress in the background without keeping the process alive; callers that
+            # need to wait for completion can call poll_import() with the returned id
+            threading.Thread(target=poll_import, args=(index, import_id), daemon=True).start()
+            return {"chunks": chunk_count, "import_id": import_id}
 
         print("Data ingested successfully.")
+        return {"chunks": chunk_count, "import_id": None}
 
     except Exception as e:
         print(f"Error processing S3 file: {e}")
-        return []
-
+        return None
 
 
-# Example test event to pass to Lambda
-test_event = {
-    "category_one": "personal",
-    "category_two": "work",
-    "file_path": "s3://il-raw-chats/agent_conversation/716b6580-0041-70b9-fb98-28d932d991be_19aa9238-3d46-46da-8bfd-a5b46486a6e4/pdf_to_json.json"
-}
+# --- Usage Example: runs only when executed directly, not on import ---
+if __name__ == "__main__":
+    # Example test event to pass to Lambda
+    test_event = {
+        "category_one": "personal",
+        "category_two": "work",
+        "file_path": "s3://il-raw-chats/agent_conversation/716b6580-0041-70b9-fb98-28d932d991be_19aa9238-3d46-46da-8bfd-a5b46486a6e4/pdf_to_json.json"
+    }
 
-# Test the ingestion process
-s3_json_load_ingest(s3_uri=test_event["file_path"], lambda_event=test_event)
+    # Test the ingestion process
+    s3_json_load_ingest(s3_uri=test_event["file_path"], lambda_event=test_event)
@@ -1,38 +1,75 @@
 import os
 import re
+import asyncio
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from typing import Optional, List, Dict, Any
 from dotenv import load_dotenv
 
 from langchain_pinecone import PineconeVectorStore
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.documents import Document
+from langchain_community.cache import SQLiteCache
+from sqlalchemy.exc import OperationalError
+
+from common import embed_query_batch, get_embeddings, get_index
 
 # Load environment variables once
 load_dotenv()
 
+# Exact-match LLM cache file; point it at a writable path such as /tmp on AWS Lambda
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.db")
+
 class RAGCitationEngine:
+    # Query vectors kept per engine, so repeated questions skip the embedding API
+    QUERY_VECTOR_CACHE_SIZE = 4096
+
+    # Semantic answer cache: near-duplicate questions above this cosine score reuse a stored answer
+    SEMANTIC_CACHE_NAMESPACE = "qa_cache"
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+    # Cached answers older than this are ignored, so newly ingested chats show up in answers
+    SEMANTIC_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+    # Citation pattern, compiled once: matches both standard [1] and fancy 【1】 brackets
+    _CITE_RE = re.compile(r"[\[【](\d+)[\]】]")
+
     def __init__(self):
         """
         Initializes the RAG Engine components (LLM, Vector Store, Embeddings).
         """
         self.index_name = os.getenv("PINECONE_INDEX")
+
+        # 0. Exact-match LLM cache, persisted across runs and attached to this engine's LLM only.
+        # Best-effort: if the file can't be created (e.g. a read-only filesystem), run without it.
+        try:
+            llm_cache = SQLiteCache(database_path=LLM_CACHE_PATH)
+        except OperationalError as e:
+            print(f"LLM cache unavailable, running without it: {e}")
+            llm_cache = False
         
-        # 1. Setup Embeddings
-        self.embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+        # 1. Setup Embeddings - must match the model the index was built with
+        self.embeddings = get_embeddings()
+        # Per-instance LRU cache of query vectors; queries are embedded from executor threads, hence the lock
+        self._query_vectors: "OrderedDict[str, tuple]" = OrderedDict()
+        self._query_vectors_lock = threading.Lock()
         
-        # 2. Setup Vector Store
-        self.vector_store = PineconeVectorStore.from_existing_index(
-            index_name=self.index_name,
+        # 2. Setup Vector Store; the index handle is also used directly for the semantic answer cache
+        self.index = get_index(self.index_name)
+        self.vector_store = PineconeVectorStore(
+            index=self.index,
             embedding=self.embeddings,
         )
         
         # 3. Setup LLM
         self.llm = ChatGroq(
             model="openai/gpt-oss-120b", # Ensure this matches your Groq model access
-            temperature=0
+            temperature=0,
+            cache=llm_cache
         )
         
         # 4. Setup Prompt Template
@@ -56,69 +93,160 @@ class RAGCitationEngine:
         # 5. Compile the Chain (Prompt -> LLM -> String Output)
         self.chain = self.prompt | self.llm | StrOutputParser()
 
-    def _get_retrieved_docs(self, chat_user: Optional[str], query: str, k: int = 10) -> List[Document]:
+    def embed_queries(self, queries: List[str]) -> List[tuple]:
         """
-        Private Helper: Fetches raw documents from Pinecone.
+        Public Method: Embeds queries with a single API call for all those not cached yet.
+        Vectors are cached, so a later query()/aquery() for the same question skips the embedding API.
+        Returns tuples so cached vectors cannot be mutated by callers.
+        """
+        found = {}
+        with self._query_vectors_lock:
+            for query in queries:
+                if query in self._query_vectors:
+                    self._query_vectors.move_to_end(query)
+                    found[query] = self._query_vectors[query]
+
+        missing = [query for query in dict.fromkeys(queries) if query not in found]
+        if missing:
+            vectors = [tuple(vector) for vector in embed_query_batch(self.embeddings, missing)]
+            found.update(zip(missing, vectors))
+            with self._query_vectors_lock:
+                self._query_vectors.update(zip(missing, vectors))
+                while len(self._query_vectors) > self.QUERY_VECTOR_CACHE_SIZE:
+                    self._query_vectors.popitem(last=False)
+
+        return [found[query] for query in queries]
+
+    def _embed_query_cached(self, query: str) -> tuple:
+        """
+        Private Helper: Embeds a single query through the query vector cache.
+        """
+        return self.embed_queries([query])[0]
+
+    def _build_filter(self, chat_user: Optional[str]) -> Dict[str, Any]:
+        """
+        Private Helper: Pinecone metadata filter restricting results to one user's chats.
+        Ingestion stores the user under "chat_account".
         """
-        pinecone_filter = {}
         if chat_user:
-            pinecone_filter = {"chat_user": {"$eq": chat_user}}
+            return {"chat_account": {"$eq": chat_user}}
+        return {}
 
-        return self.vector_store.similarity_search(
-            query,
+    def _get_retrieved_docs(self, chat_user: Optional[str], query: str, k: int = 10) -> List[Document]:
+        """
+        Private Helper: Fetches raw documents from Pinecone.
+        """
+        return self.vector_store.similarity_search_by_vector(
+            list(self._embed_query_cached(query)),
             k=k,
-            filter=pinecone_filter
+            filter=self._build_filter(chat_user)
         )
 
     def _format_docs_with_ids(self, docs: List[Document]) -> str:
         """
         Private Helper: Formats docs into "Source [1]: Text..." string.
         """
-        formatted_string = ""
-        for i, doc in enumerate(docs):
-            formatted_string += f"Source [{i+1}]:\n{doc.page_content}\n\n"
-        return formatted_string
+        return "".join(f"Source [{i+1}]:\n{doc.page_content}\n\n" for i, doc in enumerate(docs))
 
     def _extract_references(self, response_text: str, docs: List[Document]) -> List[Dict]:
         """
         Private Helper: Maps [1] or 【1】 citations back to metadata.
         """
-        # Regex matches both standard [1] and fancy 【1】 brackets
-        cited_indices = set(re.findall(r"(?:\[|【)(\d+)(?:\]|】)", response_text))
-        
+        # Single pass over the citations, marking which sources were used
+        cited = [False] * len(docs)
+        for match in self._CITE_RE.finditer(response_text):
+            # Convert "1" to index 0; skip IDs that don't exist in our docs list
+            idx = int(match.group(1)) - 1
+            if 0 <= idx < len(docs):
+                cited[idx] = True
+
+        # Walking the docs in order yields references already sorted by source ID
         references = []
-        for index_str in cited_indices:
-            try:
-                # Convert "1" to index 0
-                idx = int(index_str) - 1
-                
-                # Safety check: make sure ID exists in our docs list
-                if 0 <= idx < len(docs):
-                    doc = docs[idx]
-                    
-                    ref_data = {
-                        'source_id': f"[{index_str}]",
-                        'title': doc.metadata.get('title', 'Unknown Title'),
-                        'chat_id': doc.metadata.get('chat_id', 'N/A'),
-                        'turn_id': doc.metadata.get('turn_id', 'N/A'),
-                        'timestamp': doc.metadata.get('timestamp', 'N/A'),
-                        # Add snippet for debugging/display if needed
-                        # 'snippet': doc.page_content[:100] + "..." 
-                    }
-                    references.append(ref_data)
-            except ValueError:
+        for idx, doc in enumerate(docs):
+            if not cited[idx]:
                 continue
-        
-        # Optional: Sort references numerically for cleaner output
-        references.sort(key=lambda x: int(re.search(r'\d+', x['source_id']).group()))
-        
+
+            references.append({
+                'source_id': f"[{idx + 1}]",
+                'title': doc.metadata.get('title', 'Unknown Title'),
+                'chat_id': doc.metadata.get('chat_id', 'N/A'),
+                'turn_id': doc.metadata.get('turn_id', 'N/A'),
+                'timestamp': doc.metadata.get('timestamp', 'N/A'),
+                # Add snippet for debugging/display if needed
+                # 'snippet': doc.page_content[:100] + "..." 
+            })
+
         return references
 
+    def _cache_id(self, chat_user: Optional[str], query: str) -> str:
+        """
+        Private Helper: Stable vector id for a cached (user, question) pair.
+        """
+        return hashlib.sha256(f"{chat_user or ''}::{query}".encode("utf-8")).hexdigest()
+
+    def _lookup_cached_answer(self, chat_user: Optional[str], query_vector: List[float]) -> Optional[Dict[str, Any]]:
+        """
+        Private Helper: Returns a previously generated, unexpired answer for a near-identical question, if any.
+        The cache is best-effort: any failure is logged and treated as a miss.
+        """
+        try:
+            result = self.index.query(
+                vector=query_vector,
+                top_k=1,
+                namespace=self.SEMANTIC_CACHE_NAMESPACE,
+                filter={
+                    "chat_user": {"$eq": chat_user or ""},
+                    "cached_at": {"$gte": time.time() - self.SEMANTIC_CACHE_TTL_SECONDS},
+                },
+                include_metadata=True,
+            )
+            if not result.matches or result.matches[0].score < self.SEMANTIC_CACHE_THRESHOLD:
+                return None
+
+            metadata = result.matches[0].metadata
+            return {
+                "answer": metadata["answer"],
+                "references": json.loads(metadata["references"])
+            }
+        except Exception as e:
+            print(f"Semantic cache lookup failed: {e}")
+            return None
+
+    def _store_cached_answer(self, chat_user: Optional[str], query: str, query_vector: List[float], result: Dict[str, Any]) -> None:
+        """
+        Private Helper: Saves a generated answer so similar questions can reuse it.
+        Failures (network errors, metadata over Pinecone's size limit) are logged, never raised.
+        """
+        try:
+            self.index.upsert(
+                vectors=[(
+                    self._cache_id(chat_user, query),
+                    query_vector,
+                    {
+                        "chat_user": chat_user or "",
+                        "question": query,
+                        "answer": result["answer"],
+                        # Pinecone metadata cannot hold nested objects, so references are stored as JSON
+                        "references": json.dumps(result["references"]),
+                        "cached_at": time.time(),
+                    },
+                )],
+                namespace=self.SEMANTIC_CACHE_NAMESPACE,
+            )
+        except Exception as e:
+            print(f"Semantic cache store failed: {e}")
+
     def query(self, query: str, chat_user: Optional[str] = "") -> Dict[str, Any]:
         """
         Main Public Method: Runs the full RAG pipeline.
         Returns a dictionary with 'answer' and 'references'.
         """
+        # Step 0: Check the semantic cache before retrieving or generating
+        query_vector = list(self._embed_query_cached(query))
+        cached = self._lookup_cached_answer(chat_user, query_vector)
+        if cached is not None:
+            return cached
+
         # Step A: Retrieve
         docs = self._get_retrieved_docs(chat_user, query, k=10)
         
@@ -134,10 +262,126 @@ class RAGCitationEngine:
         # Step D: Extract References
         references = self._extract_references(ai_response, docs)
         
-        return {
+        result = {
             "answer": ai_response,
             "references": references
         }
+        self._store_cached_answer(chat_user, query, query_vector, result)
+
+        return result
+
+    async def aquery(self, query: str, chat_user: Optional[str] = "") -> Dict[str, Any]:
+        """
+        Async version of query(): the same pipeline, without blocking the event loop
+        so many queries can be in flight at once.
+        """
+        loop = asyncio.get_running_loop()
+
+        # Step 0: Check the semantic cache (sync clients run in the default executor)
+        query_vector = list(await loop.run_in_executor(None, self._embed_query_cached, query))
+        cached = await loop.run_in_executor(None, self._lookup_cached_answer, chat_user, query_vector)
+        if cached is not None:
+            return cached
+
+        # Step A: Retrieve
+        docs = await self.vector_store.asimilarity_search_by_vector(
+            query_vector,
+            k=10,
+            filter=self._build_filter(chat_user)
+        )
+
+        # Step B: Format
+        context_text = self._format_docs_with_ids(docs)
+
+        # Step C: Generate
+        ai_response = await self.chain.ainvoke({
+            "context": context_text,
+            "question": query
+        })
+
+        # Step D: Extract References
+        references = self._extract_references(ai_response, docs)
+
+        result = {
+            "answer": ai_response,
+            "references": references
+        }
+        await loop.run_in_executor(None, self._store_cached_answer, chat_user, query, query_vector, result)
+
+        return result
+
+
+class QueryCoalescer:
+    """
+    Collects queries that arrive within a short window and embeds all of the new ones
+    with a single API call, instead of one embedding round-trip per query. The batch
+    then runs through RAGCitationEngine.aquery concurrently, which finds the vectors
+    already cached; cache lookup, retrieval and generation remain per query.
+    """
+    def __init__(self, engine: RAGCitationEngine, window_seconds: float = 0.02):
+        self.engine = engine
+        self.window_seconds = window_seconds
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to tasks, so in-flight batches are held here
+        self._dispatches: set = set()
+
+    async def query(self, query: str, chat_user: Optional[str] = "") -> Dict[str, Any]:
+        """
+        Main Public Method: Queues a query and waits for its result.
+        """
+        # Created lazily, and again if used from a different event loop, so the queue
+        # and worker always belong to the running loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._collect())
+            self._dispatches = set()
+
+        future = loop.create_future()
+        await self._queue.put((query, chat_user, future))
+        return await future
+
+    async def _collect(self) -> None:
+        """
+        Private Helper: Gathers queries for one window, then dispatches them as a batch.
+        """
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.window_seconds)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # Don't wait for this batch before collecting the next one
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch: List[tuple]) -> None:
+        """
+        Private Helper: Embeds the batch's queries in one call, then runs them concurrently
+        and resolves each caller's future.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.engine.embed_queries, [query for query, _, _ in batch])
+        except Exception as e:
+            # Each aquery embeds its own question on a miss and reports the error to its caller
+            print(f"Batch query embedding failed: {e}")
+
+        results = await asyncio.gather(
+            *(self.engine.aquery(query, chat_user) for query, chat_user, _ in batch),
+            return_exceptions=True
+        )
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
 # --- Usage Example (Put this in your main.py or app.py) ---
 if __name__ == "__main__":
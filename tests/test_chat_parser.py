@@ -0,0 +1,43 @@
+import io
+import json
+
+from chat_parser import iter_chats
+
+
+def parse(payload):
+    return list(iter_chats(io.BytesIO(json.dumps(payload).encode("utf-8"))))
+
+
+CHAT_A = {"chat_id": "a", "messages": [{"turn_id": 1, "message": "hello"}]}
+CHAT_B = {"chat_id": "b", "messages": [{"turn_id": 1, "message": "hi"}, {"turn_id": 2, "message": "bye"}]}
+
+
+def test_list_of_chats():
+    assert parse([CHAT_A, CHAT_B]) == [CHAT_A, CHAT_B]
+
+
+def test_list_of_chats_is_streamed():
+    chats = iter_chats(io.BytesIO(json.dumps([CHAT_A, CHAT_B]).encode("utf-8")))
+    assert next(chats) == CHAT_A
+
+
+def test_data_wrapper():
+    assert parse({"source": "export", "data": [CHAT_A, CHAT_B]}) == [CHAT_A, CHAT_B]
+
+
+def test_single_chat():
+    assert parse(CHAT_A) == [CHAT_A]
+
+
+def test_messages_before_data_is_single_chat():
+    chat = {"chat_id": "c", "messages": CHAT_A["messages"], "data": [{"x": 1}]}
+    assert parse(chat) == [chat]
+
+
+def test_messages_after_data_is_single_chat():
+    chat = {"chat_id": "c", "data": [{"x": 1}, {"y": [2, 3]}], "messages": CHAT_A["messages"]}
+    assert parse(chat) == [chat]
+
+
+def test_unrecognized_object():
+    assert parse({"chat_id": "c"}) == []